@@ -6,7 +6,7 @@ __author__ = "Peter Wu"
 __email__ = "peter@lekensteyn.nl"
 __license__ = "MIT"
 
-import argparse, logging, os, subprocess, tempfile, zipfile
+import argparse, hashlib, json, logging, os, shutil, subprocess, tempfile, zipfile
 import odex2apk
 _logger = logging.getLogger("make-update-zip")
 
@@ -26,6 +26,14 @@ UPDATE_BINARY_PATH = "META-INF/com/google/android/update-binary"
 # See https://source.android.com/devices/tech/ota/tools.html#update-packages
 UPDATE_BINARY = os.path.join(_dirname, "update-binary.sh")
 
+# Path inside zip with symlinks and hardlinks that are created by the
+# update-binary after extracting system/. Each line has the format
+# "symlink /system/target system/link" or "hardlink system/file system/link".
+LINKS_PATH = "links.txt"
+
+# Format version of plan files written by --plan.
+PLAN_VERSION = 2
+
 default_packages = """
 GoogleLoginService GoogleServicesFramework Phonesky PrebuiltGmsCore
 """.split()
@@ -43,11 +51,25 @@ def find_files(root, prefix=""):
             # Output normal files.
             yield relative_path
 
+def get_link_target(full_path):
+    """
+    If the file is a symlink to /system/, return the destination relative to
+    /system/. Otherwise return None.
+    """
+    if not os.path.islink(full_path):
+        return None
+    target = os.readlink(full_path)
+    if not target.startswith("/system/"):
+        return None
+    return target[len("/system/"):]
+
 def get_files(rootdir, packages):
     """
     Scans for (APK) files in (rootdir)/app/(package)/ or
     (rootdir)/priv-app/(package)/. When no such directory is found, a framework
     file is instead looked up in (rootdir)/framework/(package).jar.
+
+    Symlinks to /system/ are yielded after their destination file.
     """
     for package in packages:
         # Find app dir (priv-app for system apps, app for others), relative to
@@ -84,42 +106,281 @@ def get_files(rootdir, packages):
 
             full_path = os.path.join(rootdir, path)
             if os.path.islink(full_path):
-                # For symlinks, store just the destination.
-                target = os.readlink(full_path)
+                # For symlinks, store the destination and the link itself (which
+                # is recreated by the installer).
+                target_path = get_link_target(full_path)
                 # Can only handle absolute symlinks in /system/ for now.
-                if not target.startswith("/system/"):
-                    _logger.warning("Ignoring symlink %s -> %s", relative_path,
-                            target)
+                if not target_path:
+                    _logger.warning("Ignoring symlink %s -> %s", path,
+                            os.readlink(full_path))
                     continue
-                # TODO store both links and destinations? Current approach will
-                # break if the app expects a file in its own directory...
-                path = target[len("/system/"):]
+                target_path_full = os.path.join(rootdir, target_path)
+                yield target_path_full, "system/%s" % target_path
 
-            full_path = os.path.join(rootdir, path)
             arcname = "system/%s" % path
             yield full_path, arcname
 
+def get_size(path):
+    """
+    Returns the size of a file or None if it does not exist (yet).
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+def file_digest(path):
+    """
+    Returns the SHA-256 hash of the file contents.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def make_plan(rootdir, packages, extra_files):
+    """
+    Resolves the files for the update zip without invoking Java or writing
+    anything. The resulting plan can be stored with save_plan and executed
+    later with build_zip.
+    """
+    apk_files = [] # paths
+    zip_files = [] # (path, path_in_zip)
+    links = [] # (path_in_zip, symlink target)
+    sources = {} # path_in_zip -> path
+    # Discover files (path, path_in_zip, whether APKs may need deodexing)
+    found_files = [(path, dest, True)
+                   for path, dest in get_files(rootdir, packages)]
+
+    # Add additional files
+    for path in extra_files:
+        src = os.path.join(rootdir, path)
+        dest = "system/%s" % path
+        if os.path.islink(src):
+            target_path = get_link_target(src)
+            if target_path:
+                # Add the destination, the link is recreated by the installer.
+                target_path_full = os.path.join(rootdir, target_path)
+                found_files.append((target_path_full,
+                    "system/%s" % target_path, False))
+            else:
+                _logger.warning("Storing contents of symlink %s -> %s", path,
+                        os.readlink(src))
+        found_files.append((src, dest, False))
+
+    for path, dest, is_package_file in found_files:
+        # Files can be found multiple times, e.g. via a symlink and --extra-file.
+        if dest in sources:
+            if sources[dest] != path:
+                _logger.warning("Ignoring %s, %s is already added from %s",
+                        path, dest, sources[dest])
+            continue
+        sources[dest] = path
+
+        # Only symlinks to /system/ are recreated, others are stored as file.
+        if get_link_target(path):
+            links.append((dest, os.readlink(path)))
+            continue
+        # Additional files are added as-is.
+        ext = os.path.splitext(path)[1][1:]
+        if is_package_file and ext in ("apk", "jar"):
+            apk_files.append(path)
+        zip_files.append((path, dest))
+
+    # Locate the boot files (but do not convert them yet).
+    arch, boot_odex_path = None, None
+    if apk_files:
+        arch, boot_odex_path = odex2apk.detect_paths(apk_files[0])
+        boot_odex_path = os.path.abspath(boot_odex_path)
+
+    # Find the odex files for APKs that still need to be deodexed.
+    deodex = []
+    for apk_path in apk_files:
+        if odex2apk.has_classes_dex(apk_path):
+            continue
+        # Record missing odex files, build_zip refuses to execute such plans.
+        try:
+            odex_path = odex2apk.find_odex_for_apk(apk_path, arch)
+        except RuntimeError:
+            odex_path = None
+        deodex.append({
+            "apk": os.path.abspath(apk_path),
+            "odex": os.path.abspath(odex_path) if odex_path else None,
+            "odex_size": get_size(odex_path) if odex_path else None,
+        })
+
+    files = []
+    for path, dest in zip_files:
+        size = get_size(path)
+        if size is None:
+            _logger.warning("File %s does not exist", path)
+        files.append({"source": os.path.abspath(path), "arcname": dest,
+            "size": size})
+
+    # The dex file is smaller than the odex file, so adding the odex size gives
+    # an upper bound for the uncompressed size.
+    estimated_size = sum(f["size"] or 0 for f in files)
+    estimated_size += sum(d["odex_size"] or 0 for d in deodex)
+
+    return {
+        "version": PLAN_VERSION,
+        "arch": arch,
+        "boot_odex_path": boot_odex_path,
+        "boot_convert": bool(deodex) and not os.path.isdir(boot_odex_path),
+        "deodex": deodex,
+        "files": files,
+        "links": [{"arcname": dest, "target": target}
+            for dest, target in links],
+        "estimated_size": estimated_size,
+    }
+
+def report_plan(plan):
+    if plan["boot_convert"]:
+        _logger.info("Boot files will be converted to %s",
+                plan["boot_odex_path"])
+    for item in plan["deodex"]:
+        if not item["odex"]:
+            _logger.warning("No .odex file found for %s!", item["apk"])
+            continue
+        _logger.info("Deodex %s using %s (%s bytes)", item["apk"], item["odex"],
+                item["odex_size"])
+    for item in plan["files"]:
+        _logger.info("Add %s as %s (%s bytes)", item["source"], item["arcname"],
+                item["size"])
+    for item in plan["links"]:
+        _logger.info("Link %s -> %s", item["arcname"], item["target"])
+    _logger.info("Estimated uncompressed size: %d bytes",
+            plan["estimated_size"])
+
+def save_json(data, path):
+    tmp_path = odex2apk.temp_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    odex2apk.replace_file(tmp_path, path)
+
+def save_plan(plan, plan_path):
+    save_json(plan, plan_path)
+
+def load_plan(plan_path):
+    with open(plan_path) as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise RuntimeError("Unsupported plan version in %s" % plan_path)
+    return plan
+
+def load_journal(journal_path):
+    """
+    Returns the journal of an interrupted build or None if there is none.
+    """
+    if not os.path.exists(journal_path):
+        return None
+    with open(journal_path) as f:
+        journal = json.load(f)
+    if journal["plan"].get("version") != PLAN_VERSION or \
+            "started" not in journal:
+        raise RuntimeError("Unsupported journal format in %s" % journal_path)
+    return journal
+
+def run_stage(journal, journal_path, stage, func, *args):
+    """
+    Calls func(*args) unless the stage was completed before. The stage is
+    recorded as started before and as completed after calling func.
+    """
+    if stage in journal["done"]:
+        _logger.info("Skipping completed stage: %s", stage)
+        return
+    if stage not in journal["started"]:
+        journal["started"].append(stage)
+        save_json(journal, journal_path)
+    func(*args)
+    journal["done"].append(stage)
+    save_json(journal, journal_path)
+
+def write_zip(plan, update_zip):
+    """
+    Creates the (unsigned) zip file from the files in the plan.
+    """
+    # Symlinks found in the packages.
+    links = ["symlink %s %s" % (item["target"], item["arcname"])
+             for item in plan["links"]]
+
+    # Create a zip file, replacing the output only when it is complete.
+    tmp_zip = odex2apk.temp_path(update_zip)
+    with zipfile.ZipFile(tmp_zip, "w", zipfile.ZIP_DEFLATED) as z:
+        # Add updater script
+        z.write(UPDATE_BINARY, UPDATE_BINARY_PATH)
+
+        # Add each package and related files to the the zip. Files with the same
+        # contents are stored once and hardlinked by the installer.
+        stored = {} # digest -> path_in_zip
+        for item in plan["files"]:
+            digest = file_digest(item["source"])
+            if digest in stored:
+                _logger.info("Linking %s to %s", item["arcname"], stored[digest])
+                links.append("hardlink %s %s" % (stored[digest],
+                    item["arcname"]))
+                continue
+            stored[digest] = item["arcname"]
+            _logger.info("Adding %s", item["arcname"])
+            z.write(item["source"], item["arcname"])
+
+        if links:
+            z.writestr(LINKS_PATH, "".join("%s\n" % link for link in links))
+    odex2apk.replace_file(tmp_zip, update_zip)
+
+def build_zip(journal, journal_path, update_zip):
+    """
+    Executes a plan: deodexes the APKs and creates the (unsigned) zip file.
+    Completed stages are recorded in the journal and skipped when resuming.
+    """
+    plan = journal["plan"]
+
+    missing = [item["apk"] for item in plan["deodex"] if not item["odex"]]
+    if missing:
+        raise RuntimeError("No .odex file found for %s!" % ", ".join(missing))
+
+    # Pre-processing before APK can be handled.
+    if plan["deodex"]:
+        # An interrupted conversion leaves an incomplete directory behind which
+        # process_boot would accept.
+        boot_odex_path = plan["boot_odex_path"]
+        if "boot" in journal["started"] and "boot" not in journal["done"] \
+                and os.path.isdir(boot_odex_path):
+            _logger.info("Removing incomplete boot directory %s",
+                    boot_odex_path)
+            shutil.rmtree(boot_odex_path)
+        run_stage(journal, journal_path, "boot",
+                odex2apk.process_boot, boot_odex_path)
+
+    # Deodex each package.
+    for item in plan["deodex"]:
+        _logger.debug("Deodexing %s", item["apk"])
+        run_stage(journal, journal_path, "deodex %s" % item["apk"],
+                odex2apk.process_apk, item["apk"], plan["arch"],
+                plan["boot_odex_path"], item["odex"])
+
+    run_stage(journal, journal_path, "zip", write_zip, plan, update_zip)
+
 def make_signed_zip(update_zip, public_key, private_key):
-    # Rename the original zip to -unsigned.zip
-    source_zip = "%s-unsigned%s" % os.path.splitext(update_zip)
-    _logger.debug("Renaming %s to %s", update_zip, source_zip)
-    os.rename(update_zip, source_zip)
+    # Sign to a temporary file, the unsigned zip is kept if signing fails.
+    signed_zip = odex2apk.temp_path(update_zip)
 
     # java -jar signapk.jar -w releasekey.{x509.pem,pk8} update{,-signed}.zip
     cmd = ["java", "-jar", SIGNAPK, "-w", public_key, private_key,
-            source_zip, update_zip]
+            update_zip, signed_zip]
     _logger.debug("Executing: %s", cmd)
     try:
         subprocess.check_output(cmd, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
         _logger.debug("Program output: %s", e.output.decode())
-        _logger.warning("Failed to sign zip, restoring unsigned zip")
-        # Failed to create update zip, revert rename
-        os.rename(source_zip, update_zip)
+        _logger.warning("Failed to sign zip, keeping unsigned zip")
+        if os.path.exists(signed_zip):
+            os.remove(signed_zip)
         raise
 
-    # Now that the signed zip is available, remove the unsigned one.
-    os.remove(source_zip)
+    # Now that the signed zip is available, replace the unsigned one.
+    odex2apk.replace_file(signed_zip, update_zip)
 
 parser = argparse.ArgumentParser("make-update-zip.py", description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -129,8 +390,25 @@ parser.add_argument("-f", "--extra-file", dest="extra_files", action="append",
     Additional files (such as libraries) to include on the /system/ partition
     (relative to --rootdir). This option can be given multiple times.
     """)
-parser.add_argument("-o", "--output", metavar="PATH", required=True,
+parser.add_argument("-o", "--output", metavar="PATH",
     help="Path to output update zip file.")
+parser.add_argument("--plan", metavar="PATH",
+    help="""
+    Only discover files and write the build plan to PATH. No Java programs are
+    invoked and no zip file is created.
+    """)
+parser.add_argument("--from-plan", metavar="PATH",
+    help="""
+    Build the zip from a plan file created by --plan instead of discovering
+    files (--rootdir, --extra-file and packages are ignored).
+    """)
+parser.add_argument("--resume", action="store_true",
+    help="""
+    Continue an interrupted build using the journal next to the output file
+    (PATH.journal), skipping stages that were already completed. The plan in
+    the journal is used, --from-plan, --rootdir, --extra-file and packages
+    are ignored.
+    """)
 parser.add_argument("-d", "--debug", action="store_true",
     help="Enable verbose debug logging")
 parser.add_argument("-c", "--cert", dest="public_key",
@@ -148,48 +426,66 @@ def main():
     packages = args.packages if args.packages else default_packages
     update_zip = args.output
 
-    apk_files = [] # paths
-    zip_files = [] # (path, path_in_zip)
-    # Discover files
-    for path, dest in get_files(rootdir, packages):
-        ext = os.path.splitext(path)[1][1:]
-        if ext in ("apk", "jar"):
-            apk_files.append(path)
-        zip_files.append((path, dest))
+    journal = None
+    if update_zip:
+        journal_path = "%s.journal" % update_zip
+        if args.resume:
+            journal = load_journal(journal_path)
+            if not journal:
+                _logger.warning("No journal %s found, starting a new build",
+                        journal_path)
 
-    # Add additional files
-    for path in args.extra_files:
-        src = os.path.join(rootdir, path)
-        dest = "system/%s" % path
-        zip_files.append((src, dest))
+    if journal:
+        plan = journal["plan"]
+        if args.from_plan or args.rootdir or args.extra_files or args.packages:
+            _logger.warning("Resuming with the plan from %s, ignoring "
+                    "--from-plan, --rootdir, --extra-file and packages",
+                    journal_path)
+    elif args.from_plan:
+        plan = load_plan(args.from_plan)
+    else:
+        plan = make_plan(rootdir, packages, args.extra_files)
 
-    # Pre-processing before APK can be handled.
-    arch, boot_odex_path = odex2apk.detect_paths(apk_files[0])
-    odex2apk.process_boot(boot_odex_path)
+    # Only report and store the plan, do not build anything.
+    if args.plan:
+        report_plan(plan)
+        save_plan(plan, args.plan)
+        _logger.info("Plan %s is ready!", args.plan)
+        return
 
-    # Deodex each package.
-    for apk_path in apk_files:
-        _logger.debug("Deodexing %s", apk_path)
-        # TODO check exception
-        odex2apk.process_apk(apk_path, arch, boot_odex_path)
+    if not update_zip:
+        parser.error("the following arguments are required: -o/--output")
 
-    # Create a zip file.
-    with zipfile.ZipFile(update_zip, "w", zipfile.ZIP_DEFLATED) as z:
-        # Add updater script
-        z.write(UPDATE_BINARY, UPDATE_BINARY_PATH)
+    # Start a new journal for recording completed stages.
+    if not journal:
+        # If a previous build was interrupted while converting the boot files,
+        # the (incomplete) boot directory must be converted again.
+        journal = {"plan": plan, "started": [], "done": []}
+        # A journal from an older or broken build cannot be resumed anyway.
+        try:
+            old_journal = load_journal(journal_path)
+        except (ValueError, KeyError, TypeError, RuntimeError) as e:
+            _logger.warning("Ignoring unusable journal %s: %s", journal_path, e)
+            old_journal = None
+        if old_journal and "boot" in old_journal["started"] and \
+                "boot" not in old_journal["done"] and \
+                old_journal["plan"]["boot_odex_path"] == plan["boot_odex_path"]:
+            journal["started"].append("boot")
+        save_json(journal, journal_path)
 
-        # Add each package and related files to the the zip
-        for path, dest in zip_files:
-            _logger.info("Adding %s", dest)
-            z.write(path, dest)
+    build_zip(journal, journal_path, update_zip)
 
     # Sign the zip if a key is given.
     if args.public_key and args.private_key:
         _logger.info("Created zip %s, trying to sign it...", update_zip)
-        make_signed_zip(update_zip, args.public_key, args.private_key)
+        run_stage(journal, journal_path, "sign", make_signed_zip, update_zip,
+                args.public_key, args.private_key)
     else:
         _logger.warn("Zip file %s still needs to be signed!", update_zip)
 
+    # The build is complete, the journal is no longer needed.
+    os.remove(journal_path)
+
     # Done!
     _logger.info("Update zip %s is ready!", update_zip)
 
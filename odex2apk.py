@@ -29,7 +29,7 @@ __author__ = "Peter Wu"
 __email__ = "peter@lekensteyn.nl"
 __license__ = "MIT"
 
-import argparse, sys, zipfile, os, subprocess, logging
+import argparse, sys, zipfile, os, shutil, subprocess, logging
 _logger = logging.getLogger("odex2apk")
 
 # Path to oat2dex.jar (from https://github.com/testwhat/SmaliEx.git)
@@ -40,6 +40,17 @@ OAT2DEX = os.getenv("OAT2DEX", os.path.join(_dirname, "oat2dex.jar"))
 # Supported architectures (first match will be used)
 architectures = ["x86_64", "x86", "arm64", "arm"]
 
+# os.replace is not available in Python 2, os.rename is atomic on POSIX.
+replace_file = getattr(os, "replace", os.rename)
+
+def temp_path(path):
+    """
+    Returns the path of a hidden temporary file next to the given path. Files
+    are written to this path first and then renamed over the original file.
+    """
+    dirname, filename = os.path.split(path)
+    return os.path.join(dirname, ".%s.tmp" % filename)
+
 def detect_arch(dirname):
     # Look for first available architecture (as subdir)
     for arch in architectures:
@@ -115,21 +126,35 @@ def add_classes_dex(apk_path, dex_path):
     zinfo.extract_version = xml_zinfo.extract_version
     data = open(dex_path, "rb").read()
 
-    # Write actual classes.dex.
-    with zipfile.ZipFile(apk_path, "a") as z:
+    # Write actual classes.dex to a copy such that an interrupted write does not
+    # leave a broken APK file behind.
+    tmp_path = temp_path(apk_path)
+    shutil.copy2(apk_path, tmp_path)
+    with zipfile.ZipFile(tmp_path, "a") as z:
         z.writestr(zinfo, data)
+    replace_file(tmp_path, apk_path)
 
-def process_apk(apk_path, arch, boot_odex_path):
+def has_classes_dex(apk_path):
+    """
+    Returns True if the APK or framework file already contains classes.dex.
+    """
     # Sanity check...
     ext = os.path.splitext(apk_path)[1][1:]
     if ext not in ("apk", "jar"):
         raise RuntimeError("File %s is not an APK or framework file!" % apk_path)
 
-    # Scan for classes.dex in file list
-    file_list = zipfile.ZipFile(apk_path).namelist()
-    if "classes.dex" not in file_list:
+    with zipfile.ZipFile(apk_path) as z:
+        return "classes.dex" in z.namelist()
+
+def process_apk(apk_path, arch, boot_odex_path, odex_path=None):
+    """
+    Adds classes.dex to an APK file if missing. If odex_path is not given, the
+    odex file is looked up based on the architecture.
+    """
+    if not has_classes_dex(apk_path):
         # Not found? Try to find odex file...
-        odex_path = find_odex_for_apk(apk_path, arch)
+        if not odex_path:
+            odex_path = find_odex_for_apk(apk_path, arch)
 
         # convert it to a dex file...
         dex_path = odex_to_dex(odex_path, boot_odex_path)
@@ -59,6 +59,19 @@ unzip -o "$zip_name" "system/*" -d / | while read line; do
     ui_print "unzip: $line"
 done
 
+# Recreate symlinks and files with duplicate contents (see make-update-zip.py).
+unzip -p "$zip_name" links.txt 2>/dev/null | while read type target name; do
+    mkdir -p "$(dirname "/$name")"
+    case $type in
+    symlink)
+        ui_print "symlink: /$name -> $target"
+        ln -sfn "$target" "/$name" ;;
+    hardlink)
+        ui_print "hardlink: /$name -> /$target"
+        ln -f "/$target" "/$name" ;;
+    esac
+done
+
 set_progress 0.9
 ui_print "Unmounting /system"
 umount /system